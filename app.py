@@ -1,15 +1,19 @@
 # app.py (POSベースキーワード抽出 軽量化案)
 
+import hashlib
 import streamlit as st
 import pandas as pd
-from io import StringIO
+import pyarrow as pa
 
 # nlp_processing.py から定義された関数をインポート
 from nlp_processing import (
     load_pos_pipeline_definition,
+    load_pos_pipeline_definition_fugashi,
+    start_pos_pipeline_warm_start,
     load_stopwords_from_file_definition, # ストップワードはキーワード抽出で使うかもしれないので残す
     extract_keywords_from_pos_tags, # KeyBERT版から変更
-    tag_pos_execution
+    tag_pos_execution,
+    tag_pos_execution_fugashi
 )
 
 # --- Streamlit UI ---
@@ -19,28 +23,67 @@ st.markdown("""
 Enter or upload Japanese text (e.g., user interviews) to perform POS-based keyword extraction and POS tagging.
 """)
 
+# --- 品詞タグ付けバックエンドの選択 ---
+use_fugashi_backend = st.sidebar.toggle(
+    "高速品詞タグ付け (fugashi + UniDic) を使用",
+    value=False,
+    help="BERTモデルの代わりに MeCab ベースの fugashi で品詞タグ付けを行います。"
+)
+tag_pos_function = tag_pos_execution_fugashi if use_fugashi_backend else tag_pos_execution
+if not use_fugashi_backend:
+    # BERT バックエンド選択時のみ、ロードをバックグラウンドで先行開始する
+    start_pos_pipeline_warm_start()
+
 # --- モデルとデータのロード ---
 # 品詞タグ付けモデルのみロード
-with st.spinner("必要なモデルとデータをロード中です..."):
-    pos_model_instance = None
-    japanese_stopwords_loaded = ["これ", "それ", "あれ"]
+# ロード結果はセッションに保持し、ウィジェット操作による再実行ではスピナーやロード処理を繰り返さない
+pos_backend_name = "fugashi" if use_fugashi_backend else "pipeline"
+if st.session_state.get('models_loaded', {}).get('backend') != pos_backend_name:
+    with st.spinner("必要なモデルとデータをロード中です..."):
+        pos_model_instance = None
+        japanese_stopwords_loaded = frozenset(["これ", "それ", "あれ"])
+        # ロード状況は個別に表示せず、まとめてサイドバーに1回だけ書き出す
+        load_status_lines = []
+        load_failed = False
 
-    try:
-        pos_model_instance = load_pos_pipeline_definition()
-        if pos_model_instance:
-            st.sidebar.success("品詞タグ付けパイプラインのロード完了")
-        else:
-            st.sidebar.error("品詞タグ付けパイプラインのロード失敗。機能が制限されます。")
-    except Exception as e:
-        st.sidebar.error(f"品詞タグ付けパイプラインのロード中に致命的なエラー: {e}")
+        try:
+            if use_fugashi_backend:
+                pos_model_instance = load_pos_pipeline_definition_fugashi()
+            else:
+                pos_model_instance = load_pos_pipeline_definition()
+            if pos_model_instance:
+                load_status_lines.append("品詞タグ付けパイプラインのロード完了")
+            else:
+                load_status_lines.append("品詞タグ付けパイプラインのロード失敗。機能が制限されます。")
+                load_failed = True
+        except Exception as e:
+            load_status_lines.append(f"品詞タグ付けパイプラインのロード中に致命的なエラー: {e}")
+            load_failed = True
 
-    try:
-        # ストップワードは現状の extract_keywords_from_pos_tags では未使用だが、将来的に使う可能性を考慮し残す
-        japanese_stopwords_loaded = load_stopwords_from_file_definition()
-        if japanese_stopwords_loaded:
-             st.sidebar.success(f"ストップワードリストのロード完了 (件数: {len(japanese_stopwords_loaded)})")
-    except Exception as e:
-        st.sidebar.error(f"ストップワードリストのロード中に致命的なエラー: {e}")
+        try:
+            # ストップワードは現状の extract_keywords_from_pos_tags では未使用だが、将来的に使う可能性を考慮し残す
+            japanese_stopwords_loaded = load_stopwords_from_file_definition()
+            if japanese_stopwords_loaded:
+                load_status_lines.append(f"ストップワードリストのロード完了 (件数: {len(japanese_stopwords_loaded)})")
+        except Exception as e:
+            load_status_lines.append(f"ストップワードリストのロード中に致命的なエラー: {e}")
+            load_failed = True
+
+    st.session_state['models_loaded'] = {
+        'backend': pos_backend_name,
+        'pos': pos_model_instance,
+        'stopwords': japanese_stopwords_loaded,
+        'status': ("\n\n".join(load_status_lines), load_failed)
+    }
+
+pos_model_instance = st.session_state['models_loaded']['pos']
+japanese_stopwords_loaded = st.session_state['models_loaded']['stopwords']
+
+load_status_message, load_failed = st.session_state['models_loaded']['status']
+if load_failed:
+    st.sidebar.error(load_status_message)
+else:
+    st.sidebar.success(load_status_message)
 
 
 # --- UI要素 ---
@@ -51,8 +94,8 @@ uploaded_file = st.file_uploader("または、テキストファイルをアッ
 final_input_text = ""
 if uploaded_file is not None:
     try:
-        stringio = StringIO(uploaded_file.getvalue().decode("utf-8"))
-        file_content = stringio.read()
+        # バイト列を一度だけデコードする (StringIO 経由の余分なコピーを作らない)
+        file_content = uploaded_file.getvalue().decode("utf-8")
         final_input_text = file_content
         st.text_area("ファイルの内容 (File content):", value=file_content, height=150, disabled=True, key="file_display")
     except Exception as e:
@@ -64,32 +107,45 @@ elif input_text_area:
 if 'keyword_results' not in st.session_state:
     st.session_state.keyword_results = []
 if 'pos_results' not in st.session_state:
-    st.session_state.pos_results = []
+    st.session_state.pos_results = {}
 
 
 if st.button("分析実行 (Run Analysis)"):
     if final_input_text.strip():
-        # 結果をリセット
-        st.session_state.keyword_results = []
-        st.session_state.pos_results = []
-
-        with st.spinner("分析中です...しばらくお待ちください (Analyzing... please wait...)"):
-            if pos_model_instance:
-                st.session_state.pos_results = tag_pos_execution(final_input_text, pos_model_instance)
-                # POSタグ付けの結果を使ってキーワード抽出
-                st.session_state.keyword_results = extract_keywords_from_pos_tags(
-                    st.session_state.pos_results, # POSタグの結果を渡す
-                    top_n=10
-                    # stopwords_list は extract_keywords_from_pos_tags の実装による
-                )
-            else:
-                st.warning("品詞タグ付けモデルがロードされていないため、分析をスキップします。")
-            
-            st.success("分析が完了しました。")
+        # 入力テキストと品詞タグ付けバックエンドの組み合わせが前回と同じなら再分析しない
+        analysis_hash = hashlib.blake2b(
+            f"{pos_backend_name}\0{final_input_text}".encode("utf-8"), digest_size=16
+        ).hexdigest()
+        if analysis_hash == st.session_state.get('_last_hash'):
+            st.success("前回と同じ入力のため、前回の分析結果を表示します。")
+        else:
+            # 結果をリセット
+            st.session_state.keyword_results = []
+            st.session_state.pos_results = {}
+            st.session_state['_last_hash'] = None
+
+            with st.spinner("分析中です...しばらくお待ちください (Analyzing... please wait...)"):
+                if pos_model_instance:
+                    # 列指向の結果を一度だけ Arrow Table に変換してセッションに保持する
+                    st.session_state.pos_results = pa.table(tag_pos_function(final_input_text, pos_model_instance))
+                    # POSタグ付けの結果を使ってキーワード抽出
+                    st.session_state.keyword_results = extract_keywords_from_pos_tags(
+                        st.session_state.pos_results, # POSタグの結果を渡す
+                        top_n=10
+                        # stopwords_list は extract_keywords_from_pos_tags の実装による
+                    )
+                    # 品詞タグ付けが失敗した (結果が空の) 場合は記録せず、同じ入力での再試行を許可する
+                    if st.session_state.pos_results.num_rows:
+                        st.session_state['_last_hash'] = analysis_hash
+                else:
+                    st.warning("品詞タグ付けモデルがロードされていないため、分析をスキップします。")
+                
+                st.success("分析が完了しました。")
     else:
         st.warning("テキストが入力されていません (Please enter some text to analyze).")
         st.session_state.keyword_results = []
-        st.session_state.pos_results = []
+        st.session_state.pos_results = {}
+        st.session_state['_last_hash'] = None
 
 
 # --- 結果表示セクション ---
@@ -119,15 +175,16 @@ if final_input_text.strip() and (st.session_state.keyword_results or st.session_
     st.subheader("品詞タグ付け (Part-of-Speech Tagging)")
     if pos_model_instance and st.session_state.pos_results:
         try:
-            pos_df = pd.DataFrame(st.session_state.pos_results)
-            st.write(f"**トークン数 (Token Count):** {len(pos_df)}")
-            st.dataframe(pos_df[['text', 'pos']], height=300) # lemmaとtagは内容により省略も可
+            pos_results = st.session_state.pos_results
+            st.write(f"**トークン数 (Token Count):** {pos_results.num_rows}")
+            # Arrow Table をそのまま渡し、pandas DataFrame の生成を省く
+            st.dataframe(pos_results.select(['text', 'pos']), height=300) # lemmaとtagは内容により省略も可
         except Exception as e:
             st.error(f"品詞タグ付け結果の表示中にエラー: {e}")
             st.write(f"生データ: {st.session_state.pos_results}")
     elif not pos_model_instance:
         st.info("品詞タグ付けモデルが利用できません。")
-    elif st.session_state.pos_results == []:
+    elif not st.session_state.pos_results:
         st.info("品詞タグは見つかりませんでした。")
 
 elif not final_input_text.strip() and not (st.session_state.keyword_results or st.session_state.pos_results):
@@ -1,24 +1,89 @@
 # nlp_processing.py (POSベースキーワード抽出 軽量化案)
 
+import hashlib
+import os
+import re
+import threading
+import warnings
+from operator import itemgetter
+from pathlib import Path
 import streamlit as st
-from transformers import pipeline, AutoTokenizer, AutoModelForTokenClassification
-from collections import Counter # For keyword counting
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc # For keyword counting
+
+# torch / transformers / fugashi は重いため、それぞれのロード関数の中で初めて使うときにインポートする
+# (fugashi バックエンドだけを使うセッションでは torch / transformers は読み込まれない)
+
+def _read_torch_num_threads():
+    """環境変数 TORCH_NUM_THREADS を正の整数として読み取ります。未設定・不正な値の場合は None を返します。"""
+    value = os.environ.get("TORCH_NUM_THREADS", "").strip()
+    if not value:
+        return None
+    try:
+        num_threads = int(value)
+    except ValueError:
+        warnings.warn(f"TORCH_NUM_THREADS の値が不正です ({value!r})。PyTorch の既定のスレッド数を使用します。")
+        return None
+    return num_threads if num_threads > 0 else None
+
+
+# PyTorch の CPU スレッド数 (複数ワーカーで動かす場合は TORCH_NUM_THREADS でコアを分割する)
+# 未設定の場合は上書きせず、物理コア数を使う PyTorch の既定値に任せる
+# OpenMP / MKL のスレッドプールは torch のインポート前に設定しておく必要がある
+TORCH_NUM_THREADS = _read_torch_num_threads()
+if TORCH_NUM_THREADS is not None:
+    os.environ.setdefault("OMP_NUM_THREADS", str(TORCH_NUM_THREADS))
+    os.environ.setdefault("MKL_NUM_THREADS", str(TORCH_NUM_THREADS))
+
+# CPU で品詞タグ付けモデルを int8 に動的量子化するかどうか (精度への影響が未検証のため既定では無効)
+POS_QUANTIZE_INT8 = os.environ.get("POS_QUANTIZE_INT8", "").strip().lower() in ("1", "true", "yes")
 
 # KeyBERT と SentenceTransformer は不要になる
 
+# 品詞タグ付けの入力を文単位に分割する際の設定
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[。．！？!?\n])")
+POS_MAX_CHUNK_CHARS = 256 # 1チャンクあたりの最大文字数 (モデルの最大長 512 トークンを超えないように)
+POS_SOFT_BREAK_CHARS = frozenset("、，,;；:：」』）)] 　\t") # 長すぎる文を区切る際に優先する位置 (この文字の直後で区切る)
+POS_PIPELINE_BATCH_SIZE = 16
+
+# ストップワードファイルが読み込めない場合のデフォルト (インポート時に一度だけ生成)
+DEFAULT_STOPWORDS_FOR_FALLBACK = frozenset(["これ", "それ", "あれ", "この", "その", "あの", "私", "あなた", "彼", "彼女", "です", "ます", "ました", "する", "いる", "ある", "の", "は", "が", "を", "に", "へ", "と", "も", "や", "で"])
+
 # --- モデル読み込み関数の定義 ---
 
-@st.cache_resource
+@st.cache_resource(show_spinner=False, max_entries=1)
 def load_pos_pipeline_definition():
     """品詞タグ付けのための Transformers Pipeline をロードして返します。"""
     try:
+        import torch
+        from transformers import pipeline, AutoTokenizer, AutoModelForTokenClassification
+
+        if TORCH_NUM_THREADS is not None:
+            torch.set_num_threads(TORCH_NUM_THREADS)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # 並列処理の開始後 (Streamlit によるモジュールの再読み込み時など) は変更できない
+            pass
+
         model_name = "cl-tohoku/bert-base-japanese-wikipedia-cabocha-pos-sup"
         tokenizer = AutoTokenizer.from_pretrained(model_name)
         model = AutoModelForTokenClassification.from_pretrained(model_name)
+        model.eval()
+        device = -1
+        if torch.cuda.is_available():
+            # GPUではFP16で推論し、メモリ帯域と行列演算のスループットを改善する
+            model = model.half()
+            device = 0
+        elif POS_QUANTIZE_INT8:
+            # CPUでは Linear 層を int8 に動的量子化し、推論時間とメモリ使用量を削減する
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
         pos_tagger = pipeline(
             "token-classification",
             model=model,
             tokenizer=tokenizer,
+            device=device,
             aggregation_strategy="simple" # サブワードをまとめる
         )
         return pos_tagger
@@ -27,6 +92,26 @@ def load_pos_pipeline_definition():
         # エラー発生時はNoneを返すことで、app.py側で処理をスキップできるようにする
         return None
 
+@st.cache_resource(show_spinner=False)
+def load_pos_pipeline_definition_fugashi():
+    """品詞タグ付けのための fugashi (MeCab) + UniDic の Tagger をロードして返します。"""
+    try:
+        import fugashi # トグルで選択された場合にのみインポートする
+        return fugashi.Tagger()
+    except Exception as e:
+        st.error(f"fugashi Tagger のロード中にエラーが発生しました: {e}")
+        return None
+
+@st.cache_resource(show_spinner=False)
+def start_pos_pipeline_warm_start():
+    """BERT パイプラインのロードをバックグラウンドで開始します。
+
+    st.cache_resource によりプロセスごとに1回だけスレッドを起動します。
+    """
+    warm_start_thread = threading.Thread(target=load_pos_pipeline_definition, name="pos-pipeline-warm-start", daemon=True)
+    warm_start_thread.start()
+    return warm_start_thread
+
 # --- 分析実行関数の定義 ---
 
 def extract_keywords_from_pos_tags(pos_tagged_output, top_n=10, target_pos_prefixes=("名詞", "固有名詞", "形容詞")):
@@ -34,72 +119,182 @@ def extract_keywords_from_pos_tags(pos_tagged_output, top_n=10, target_pos_prefi
     品詞タグ付けの結果からキーワードを抽出します。
     指定された品詞（名詞、固有名詞、形容詞など）の単語を抽出し、頻度順に上位N件を返します。
     """
-    if not pos_tagged_output:
+    if not pos_tagged_output or top_n <= 0:
+        # Counter.most_common(0) と同様に、上位0件以下の指定では空リストを返す
         return []
 
-    keywords = []
-    for token_info in pos_tagged_output:
-        # token_info は {'text': '単語', 'pos': '品詞(-詳細品詞)'} のような辞書を期待
-        # 'pos' の主要な品詞カテゴリをチェック (例: "名詞-普通名詞-一般" -> "名詞")
-        main_pos = token_info.get('pos', '').split('-')[0]
-        if main_pos in target_pos_prefixes:
-            keywords.append(token_info['text'])
+    # 品詞タグ付けの結果を Arrow の列として扱い、トークンごとの Python ループを
+    # Arrow compute カーネルによるベクトル演算に置き換える
+    table = pos_tagged_output if isinstance(pos_tagged_output, pa.Table) else pa.table(pos_tagged_output)
+    # 'pos' の主要な品詞カテゴリをチェック (例: "名詞-普通名詞-一般" -> "名詞")
+    # split でリストを作らず、完全一致または "品詞-" で始まるかどうかで判定する
+    pos = pc.fill_null(table['pos'], '')
+    is_target = pc.is_in(pos, value_set=pa.array(list(target_pos_prefixes), type=pa.string()))
+    for prefix in target_pos_prefixes:
+        is_target = pc.or_(is_target, pc.starts_with(pos, pattern=prefix + '-'))
+    keywords = pc.filter(table['text'], is_target)
 
-    if not keywords:
+    if len(keywords) == 0:
         return []
 
-    # 単語の出現頻度をカウント
-    keyword_counts = Counter(keywords)
-    
-    # 頻度上位のキーワードを取得
+    # 単語の出現頻度をカウントし、頻度上位のキーワードを取得
     # KeyBERTの出力形式に合わせて [(keyword, relevance_score), ...] とする
-    # ここでは relevance_score を正規化された頻度とする（例）
-    # もしくは、単純にカウント数でも良い
-    most_common_keywords = keyword_counts.most_common(top_n)
-    
-    # アプリケーションの表示に合わせて整形 (キーワード, 関連度)
     # ここでは関連度をカウント数そのまま使用
-    formatted_keywords = [[kw, count] for kw, count in most_common_keywords]
+    keyword_counts = pc.value_counts(keywords) # 出現順に並んだ {values, counts}
+    counts = keyword_counts.field('counts').to_numpy()
+    if top_n < len(counts):
+        # 全体をソートせず、上位N件のしきい値を部分選択 (O(N)) で求める
+        # 同数の場合は Counter.most_common と同じく出現順を優先する
+        threshold = np.partition(counts, len(counts) - top_n)[len(counts) - top_n]
+        above = np.flatnonzero(counts > threshold)
+        ties = np.flatnonzero(counts == threshold)[:top_n - len(above)]
+        top_indices = np.concatenate([above, ties])
+    else:
+        top_indices = np.arange(len(counts))
+    order = top_indices[np.lexsort((top_indices, -counts[top_indices]))]
+    most_common_keywords = keyword_counts.take(pa.array(order))
+
+    # アプリケーションの表示に合わせて整形 (キーワード, 関連度)
+    formatted_keywords = [
+        [kw, count] for kw, count in zip(
+            most_common_keywords.field('values').to_pylist(),
+            most_common_keywords.field('counts').to_pylist()
+        )
+    ]
     
     return formatted_keywords
 
 
+def _split_text_for_pos(text, max_chars=POS_MAX_CHUNK_CHARS):
+    """
+    テキストを文境界 (。．！？ や改行) で分割し、長すぎる文は max_chars 以内で区切ります。
+    区切り文字は直前の文に残すため、品詞タグ付けの結果から句読点が失われません。
+    長すぎる文は上限より前の最後の読点・空白・閉じ括弧の直後で区切り、
+    それらが見つからない場合のみ max_chars の位置で機械的に区切ります。
+    """
+    chunks = []
+    for sentence in SENTENCE_BOUNDARY_PATTERN.split(text):
+        if not sentence.strip():
+            continue
+        while len(sentence) > max_chars:
+            cut = max_chars
+            for i in range(max_chars - 1, 0, -1):
+                if sentence[i] in POS_SOFT_BREAK_CHARS:
+                    cut = i + 1
+                    break
+            if sentence[:cut].strip():
+                chunks.append(sentence[:cut])
+            sentence = sentence[cut:]
+        if sentence.strip():
+            chunks.append(sentence)
+    return chunks
+
+
+@st.cache_data(show_spinner=False, max_entries=2048, ttl=3600)
+def _run_pos_pipeline_cached(text_digest, model_name, _text, _pos_pipeline_instance):
+    """
+    パイプラインの推論結果をテキストのハッシュ値とモデル名をキーにキャッシュします。
+    同じテキストで再実行した場合はモデルの推論をスキップします。
+    キャッシュには score や start/end を含む生の出力ではなく、(単語の列, 品詞の列) だけを保持します。
+    (_ で始まる引数はStreamlitのハッシュ計算の対象外)
+    """
+    chunks = _split_text_for_pos(_text)
+    if not chunks:
+        return [], []
+    # 文単位の短い系列をまとめてバッチ推論する (長い1系列よりアテンションの計算量が小さい)
+    # 長さ順に並べてからバッチにすることで、バッチ内のパディングを最小限にする
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]))
+    import torch # ロード関数で既にインポート済みのため、ここでは sys.modules から取得されるだけ
+
+    # 推論時は autograd の記録を行わない (grad モードはスレッドごとのため呼び出し側で明示する)
+    with torch.inference_mode():
+        sorted_results = _pos_pipeline_instance([chunks[i] for i in order], batch_size=POS_PIPELINE_BATCH_SIZE)
+    chunk_results = [None] * len(chunks)
+    for i, entities in zip(order, sorted_results):
+        chunk_results[i] = entities
+    # pipelineの出力例: [{'entity_group': '名詞-普通名詞-一般', 'score': 0.999, 'word': '開発', ...}, ...]
+    # word と entity_group (品詞タグ 例: 名詞-普通名詞-一般) だけを1回の走査で列に分解する
+    entity_pairs = [itemgetter('word', 'entity_group')(entity) for entities in chunk_results for entity in entities]
+    if not entity_pairs:
+        return [], []
+    words, pos_labels = map(list, zip(*entity_pairs))
+    return words, pos_labels
+
+
 def tag_pos_execution(text, pos_pipeline_instance):
-    """品詞タグ付けを実行します (Transformers Pipeline版)。"""
+    """
+    品詞タグ付けを実行します (Transformers Pipeline版)。
+    結果はトークンごとの辞書のリストではなく、列指向の辞書
+    {"text": [...], "lemma": [...], "pos": [...], "tag": [...]} で返します。
+    """
+    if not text or not text.strip():
+        # 空白のみの入力ではモデルを呼び出さない
+        return {}
     if pos_pipeline_instance is None:
         st.warning("品詞タグ付けパイプラインが利用できません。")
-        return []
+        return {}
     try:
-        # pipelineの出力例: [{'entity_group': '名詞-普通名詞-一般', 'score': 0.999, 'word': '開発', ...}, ...]
-        raw_results = pos_pipeline_instance(text)
-        pos_tags = []
-        for entity in raw_results:
-            pos_tags.append({
-                "text": entity['word'],
-                "lemma": entity['word'],  # lemma は text で代用
-                "pos": entity['entity_group'], # 品詞タグ (例: 名詞-普通名詞-一般)
-                "tag": entity['entity_group'] # 詳細タグの代わりにposを使用
-            })
-        return pos_tags
+        text_digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        model_name = pos_pipeline_instance.model.config._name_or_path
+        words, pos_labels = _run_pos_pipeline_cached(text_digest, model_name, text, pos_pipeline_instance)
+        if not words:
+            return {}
+        return {
+            "text": words,
+            "lemma": words,  # lemma は text で代用
+            "pos": pos_labels,
+            "tag": pos_labels # 詳細タグの代わりにposを使用
+        }
     except Exception as e:
         st.error(f"品詞タグ付け (pipeline) の実行中にエラーが発生しました: {e}")
-        return []
+        return {}
+
+def _join_unidic_pos(*pos_levels):
+    """UniDic の品詞階層 (pos1, pos2, ...) を "名詞-普通名詞-一般" の形式に連結します。"""
+    return "-".join(p for p in pos_levels if p and p != "*")
+
+
+def tag_pos_execution_fugashi(text, fugashi_tagger_instance):
+    """
+    品詞タグ付けを実行します (fugashi + UniDic版)。
+    tag_pos_execution と同じ列指向の辞書を返します。
+    """
+    if not text or not text.strip():
+        return {}
+    if fugashi_tagger_instance is None:
+        st.warning("fugashi Tagger が利用できません。")
+        return {}
+    try:
+        words = fugashi_tagger_instance(text)
+        if not words:
+            return {}
+        # surface と feature の属性参照はトークンごとに一度にまとめる
+        features = [(w.surface, w.feature) for w in words]
+        return {
+            "text": [surface for surface, _ in features],
+            # UniDic の外来語の語彙素には "ユーザー-user" のように原語が付くため取り除く
+            "lemma": [(f.lemma or "").split("-", 1)[0] or surface for surface, f in features],
+            "pos": [_join_unidic_pos(f.pos1, f.pos2, f.pos3) for _, f in features],
+            "tag": [_join_unidic_pos(f.pos1, f.pos2, f.pos3, f.pos4) for _, f in features]
+        }
+    except Exception as e:
+        st.error(f"品詞タグ付け (fugashi) の実行中にエラーが発生しました: {e}")
+        return {}
 
 @st.cache_data
 def load_stopwords_from_file_definition(filepath="stopwords-ja.txt"):
-    """ストップワードファイルをロードします。"""
-    # (変更なし)
-    default_stopwords_for_fallback = ["これ", "それ", "あれ", "この", "その", "あの", "私", "あなた", "彼", "彼女", "です", "ます", "ました", "する", "いる", "ある", "の", "は", "が", "を", "に", "へ", "と", "も", "や", "で"]
+    """ストップワードファイルをロードします。メンバー判定を O(1) にするため frozenset で返します。"""
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            stopwords = [line.strip() for line in f if line.strip()]
+        # ファイル全体を一度に読み込む (utf-8-sig で先頭の BOM も取り除く)
+        content = Path(filepath).read_text(encoding="utf-8-sig")
+        stopwords = frozenset(word for word in map(str.strip, content.splitlines()) if word)
         if not stopwords:
              st.info(f"ストップワードファイル {filepath} は空です。デフォルトの短いリストを使用します。")
-             return default_stopwords_for_fallback
-        return list(set(stopwords))
+             return DEFAULT_STOPWORDS_FOR_FALLBACK
+        return stopwords
     except FileNotFoundError:
         st.warning(f"ストップワードファイル {filepath} が見つかりません。デフォルトの短いリストを使用します。")
-        return default_stopwords_for_fallback
+        return DEFAULT_STOPWORDS_FOR_FALLBACK
     except Exception as e:
         st.error(f"ストップワードファイルの読み込み中にエラーが発生しました ({filepath}): {e}")
-        return default_stopwords_for_fallback
+        return DEFAULT_STOPWORDS_FOR_FALLBACK